@@ -22,11 +22,12 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
-from collections import defaultdict
 import argparse
-import json
+import multiprocessing
 import re
-from bs4 import BeautifulSoup
+from lxml import etree
+import lxml.html
+import ujson
 
 """
 Read site.do\?siteId\=N files resulting from wget and extract out a dictionary suitable
@@ -77,104 +78,168 @@ blahblahblah
 
 """
 
-def snarf_file(fname):
+_ID_RE = re.compile(r'\d+')
+_STRIP_RE = re.compile(r'[\s.\-]+')
+_ABSTRACT_RE = re.compile(r'abstract-paper-(?P<legacyid>\d+)')
+
+# xpath expressions are compiled once here rather than re-parsed for every
+# file. The indexed forms, (...)[1], stop at the first match. Lookups by id
+# go through id(), which uses libxml2's id table instead of walking the
+# whole document.
+#
+# The coder divs are the only thing left that needs a full walk of the
+# tree. The title sits directly under <head>, or under <body> when wget's
+# saved HTTP headers come first, so it is read without descending.
+_XP_TITLE = etree.XPath('(/html/*/title)[1]')
+_XP_AUTHORS = etree.XPath('id("author-names")[self::div]/span')
+_XP_JOURNAL = etree.XPath('(id("journal")[self::div]/span)[1]')
+_XP_LINKS = etree.XPath('.//a[@href]')
+_XP_CODERS = etree.XPath('//div[@style="width: 180px; float: left;"]')
+_XP_NAME = etree.XPath('(.//p[@class="name"])[1]')
+_XP_AFFILIATION = etree.XPath('(.//p[@class="affiliation"])[1]')
+_XP_COUNTRY = etree.XPath('(.//p[@class="country"])[1]')
+_XP_ABSTRACT = etree.XPath(
+    '(id($divid)[self::div]/div[@class="middle-abstract-paper"])[1]')
+_XP_EXPLANATORY = etree.XPath('id("top-resume-code")')
+
+# the scraped pages are all served as utf-8, so tell the parser up front
+# instead of having it sniff every file. Each pool worker gets its own copy.
+_PARSER = lxml.html.HTMLParser(encoding='utf-8')
+
+
+def node_text(el):
+    """ return all the text inside el
+
+    names, titles and the like are a single text node, so read that
+    directly and only walk the descendants when there are any
+    """
+    if len(el) == 0:
+        return el.text or ''
+    return el.text_content()
+
+
+def first_text(xpath, node, **variables):
+    """ run a precompiled xpath that selects at most one element and
+    return that element's text, or None when nothing matched
+    """
+    found = xpath(node, **variables)
+    if len(found) == 0:
+        return None
+    return node_text(found[0])
+
+
+def snarf_file(fname, legacy_id):
     """ read file and extract data to import to the new site
     returns dictionary filled with data
     """
-    # we are globbing files that are named like this: 'site.do?siteId=62'
-    m = re.search(r'\d+', f)
-    if m is None:
-        return {}
-
-    legacy_id = m.group()
-
-    with open(fname) as fh:
-        soup = BeautifulSoup(fh)
-        d = {}
-        d['title'] = soup.title.text
-        d['abstract'] = get_abstract(soup, legacy_id)
-        d['explanatory_text'] = get_explanatory_text(soup)
-        d['names'] = get_names(soup)
-        d.update(get_journal_data(soup))
-        coders = get_coders(soup)
-        d['coders'] = coders
-        d['legacy_id'] = legacy_id
-        return d
+    doc = read_page(fname)
+    d = {}
+    d['title'] = first_text(_XP_TITLE, doc)
+    d['abstract'] = get_abstract(doc, legacy_id)
+    d['explanatory_text'] = get_explanatory_text(doc)
+    d['names'] = get_names(doc)
+    d.update(get_journal_data(doc))
+    coders = get_coders(doc)
+    d['coders'] = coders
+    d['legacy_id'] = legacy_id
+    return d
+
+
+def snarf_job(job):
+    """ unpack a (fname, legacy_id) pair for Pool.imap_unordered """
+    return snarf_file(*job)
+
+
+def read_page(fname):
+    """ read the whole file as bytes and parse it with the shared parser """
+    with open(fname, 'rb') as fh:
+        data = fh.read()
+    return lxml.html.document_fromstring(data, parser=_PARSER)
+
 
 def print_usernames(fname):
-    with open(fname) as fh:
-        soup = BeautifulSoup(fh)
-        spans = soup.select('div#author-names > span')
-        for n in spans:
-            print re.sub(r'\s+|\.|-', '', n.text).strip()
+    doc = read_page(fname)
+    spans = _XP_AUTHORS(doc)
+    for n in spans:
+        print _STRIP_RE.sub('', node_text(n))
 
 
 def clean_text(text):
-    return re.sub(r'\s+', ' ', text).strip()
+    return ' '.join(text.split())
 
 
-def get_coders(soup):
+def get_coders(doc):
     """ extracts coder information in to a dict of dicts for each coder """
 
     # grabs a list of divs, some of them have redundent info
-    coderdivs = soup.find_all("div", style="width: 180px; float: left;")
-    coders = defaultdict(dict)
+    coderdivs = _XP_CODERS(doc)
+    coders = {}
+    seen = set()
     for div in coderdivs:
-        names = div.select('p.name')
-        if len(names) == 0:
+        name = first_text(_XP_NAME, div)
+        if name is None:
             continue
-        name = clean_text(names[0].text)
-        if name in coders:
+        name = clean_text(name)
+        if name in seen:
             continue
-        affiliations = div.select('p.affiliation')
-        countrys = div.select('p.country')
-        if len(affiliations) > 0:
-            coders[name]['affiliation'] = clean_text(affiliations[0].text)
-        if len(countrys) > 0:
-            coders[name]['country'] = clean_text(countrys[0].text)
+        seen.add(name)
+        affiliation = first_text(_XP_AFFILIATION, div)
+        country = first_text(_XP_COUNTRY, div)
+        info = {}
+        if affiliation is not None:
+            info['affiliation'] = clean_text(affiliation)
+        if country is not None:
+            info['country'] = clean_text(country)
+        if info:
+            coders[name] = info
     return coders
 
 
-def get_names(soup):
-    spans = soup.select('div#author-names > span')
+def get_names(doc):
+    spans = _XP_AUTHORS(doc)
     names = []
     for n in spans:
-        names.append(clean_text(n.text))
+        names.append(clean_text(node_text(n)))
     return names
 
 
-def get_journal_data(soup):
+def get_journal_data(doc):
     d = {}
-    journalsoup = soup.select('div#journal > span')
+    journalsoup = _XP_JOURNAL(doc)
     if len(journalsoup) == 0:
         return d
     journal = journalsoup[0]
-    d['journal'] = clean_text(journal.text)
+    d['journal'] = clean_text(node_text(journal))
 
-    links = journal.select('a')
+    links = _XP_LINKS(journal)
     for link in links:
-        m = re.search(r'abstract-paper-(?P<legacyid>\d+)', link['href'])
+        href = link.get('href')
+        # most links are plain article urls, only run the regex on the
+        # ones that can actually point at an abstract
+        m = None
+        if 'abstract-paper-' in href:
+            m = _ABSTRACT_RE.search(href)
         if m:
             d['legacyid'] = m.group('legacyid')
         else:
-            d['article_url'] = link['href']
+            d['article_url'] = href
     return d
 
 
-def get_abstract(soup, legacy_id):
-    abstract_results = soup.select('div#abstract-paper-'+legacy_id+' > div.middle-abstract-paper')
-    if len(abstract_results):
-        return clean_text(abstract_results[0].text)
+def get_abstract(doc, legacy_id):
+    abstract = first_text(_XP_ABSTRACT, doc, divid='abstract-paper-'+legacy_id)
+    if abstract is not None:
+        return clean_text(abstract)
     return ''
 
 
-def get_explanatory_text(soup):
+def get_explanatory_text(doc):
     # there should be only one abstract, stop at the first result
-    abstract_results = soup.find_all(id='top-resume-code', limit=1)
-    if len(abstract_results):
-        return clean_text(abstract_results[0].text)
+    explanatory = first_text(_XP_EXPLANATORY, doc)
+    if explanatory is not None:
+        return clean_text(explanatory)
     return ''
-    
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="""
@@ -186,11 +251,32 @@ if __name__ == '__main__':
     """)
     parser.add_argument('files', metavar='N', nargs='+', help='a list of files to scrape.')
     args = parser.parse_args()
-    datalist = []
+    # we are globbing files that are named like this: 'site.do?siteId=62'
+    # anything without an id is skipped before we bother parsing it, and
+    # so is a path we have already queued (overlapping globs repeat them)
+    jobs = []
+    queued = set()
     for f in args.files:
-        d = snarf_file(f)
-        datalist.append(d)
-
-    fout = open('results.json', 'w+')
-    json.dump(datalist, fout, indent=2)
-    fout.close()
+        if f in queued:
+            continue
+        queued.add(f)
+        m = _ID_RE.search(f)
+        if m is not None:
+            jobs.append((f, m.group()))
+
+    # each file is independent, so spread the parsing over all cores and
+    # write every record out as soon as it comes back rather than holding
+    # the whole list in memory
+    pool = multiprocessing.Pool()
+    try:
+        with open('results.json', 'w') as fout:
+            fout.write('[')
+            sep = '\n'
+            for d in pool.imap_unordered(snarf_job, jobs, chunksize=16):
+                fout.write(sep)
+                fout.write(ujson.dumps(d, indent=2, escape_forward_slashes=False))
+                sep = ',\n'
+            fout.write('\n]\n')
+    finally:
+        pool.close()
+        pool.join()